@@ -0,0 +1,335 @@
+"""
+Sphinx extension for serving responsive image derivatives.
+
+The figures of the book are stored as full-resolution PNG/JPEG files. During
+the HTML build this extension generates smaller WebP/AVIF versions of every
+raster image at a few widths, and renders the images as a ``<picture>`` element
+with ``srcset`` candidates and lazy loading. The original file is kept as the
+``<img>`` fallback, so browsers without WebP/AVIF support get the same page as
+before.
+
+Derivatives are named after the SHA-256 hash of the source file and a short
+hash of the encoding settings (quality and Pillow version), and stored in a
+cache directory that survives ``make clean``. Unchanged images are therefore
+never reprocessed, and derivatives of images that are no longer used are
+removed from the cache at the end of the image stage. Changing the quality or
+upgrading Pillow changes the file names, so the derivatives are regenerated
+automatically.
+
+Configuration values (set in ``conf.py``):
+
+- ``responsive_images_enabled``: Turn the image stage on or off.
+- ``responsive_images_widths``: Target widths (in pixels) of the derivatives.
+- ``responsive_images_formats``: Output formats, e.g. ``["avif", "webp"]``.
+- ``responsive_images_quality``: Encoder quality (0-100).
+- ``responsive_images_sizes``: Value of the ``sizes`` attribute.
+- ``responsive_images_cache_dir``: Cache directory, relative to ``conf.py``
+  (default: ``.image-cache`` next to the source directory).
+- ``responsive_images_max_workers``: Number of processes (0 = all CPUs).
+"""
+
+import hashlib
+import os
+import posixpath
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+from docutils import nodes
+from sphinx.util import logging
+
+try:
+    import PIL
+    from PIL import Image, features
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Source image types that are converted (vector graphics and GIFs are left as-is)
+RASTER_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+# Output directory of the derivatives inside the HTML build directory
+OUTPUT_DIR = posixpath.join("_images", "responsive")
+
+MIME_TYPES = {"avif": "image/avif", "webp": "image/webp"}
+
+# Bump when the way the derivatives are encoded changes, so that the cached
+# derivatives are regenerated (2: embed the source ICC profile)
+ENCODER_VERSION = 2
+
+# File names written by derivative_name(), optionally with the temporary
+# suffix used while a derivative is being encoded
+DERIVATIVE_PATTERN = re.compile(
+    r"[0-9a-f]{20}-[0-9a-f]{8}-\d+w\.(%s)(\.\d+\.tmp)?" % "|".join(MIME_TYPES)
+)
+
+
+def file_hash(path):
+    """Returns the SHA-256 hex digest of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def target_widths(source_width, widths):
+    """
+    Returns the derivative widths for an image.
+
+    Parameters
+    ----------
+    source_width: <int>
+        Width of the source image in pixels.
+    widths: <list>
+        Configured target widths.
+
+    Returns
+    -------
+    <list>
+        Configured widths smaller than the source, plus the source width itself
+        (images are never upscaled).
+    """
+    return sorted({w for w in widths if w < source_width} | {source_width})
+
+
+def encoding_key(quality):
+    """Returns a short hash of the settings that affect the encoded output."""
+    settings = f"quality={quality};pillow={PIL.__version__};version={ENCODER_VERSION}"
+    return hashlib.sha256(settings.encode()).hexdigest()[:8]
+
+
+def derivative_name(digest, key, width, fmt):
+    """Returns the file name of a derivative."""
+    return f"{digest[:20]}-{key}-{width}w.{fmt}"
+
+
+def make_derivatives(source, digest, widths, formats, quality, cache_dir):
+    """
+    Writes the resized derivatives of a single image to the cache directory.
+
+    Runs in a worker process, so it only takes picklable arguments.
+    """
+    key = encoding_key(quality)
+    with Image.open(source) as img:
+        # The WebP encoder only embeds a color profile when it is passed to
+        # save(), so read it before the image is converted
+        save_options = {"quality": quality}
+        if img.info.get("icc_profile"):
+            save_options["icc_profile"] = img.info["icc_profile"]
+
+        # WebP/AVIF do not support palette images
+        if img.mode not in ("RGB", "RGBA"):
+            has_alpha = "A" in img.getbands() or "transparency" in img.info
+            img = img.convert("RGBA" if has_alpha else "RGB")
+
+        for width in widths:
+            height = max(1, round(img.height * width / img.width))
+            resized = (
+                img
+                if width == img.width
+                else img.resize((width, height), Image.LANCZOS)
+            )
+            for fmt in formats:
+                path = os.path.join(cache_dir, derivative_name(digest, key, width, fmt))
+                if os.path.exists(path):
+                    continue
+                # Write to a temporary file first so that an interrupted build
+                # never leaves a truncated file in the cache
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                try:
+                    resized.save(tmp_path, format=fmt.upper(), **save_options)
+                    os.replace(tmp_path, path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+    return source
+
+
+def supported_formats(formats):
+    """Drops the output formats that the installed Pillow cannot write."""
+    supported = []
+    for fmt in formats:
+        if fmt in MIME_TYPES and features.check(fmt):
+            supported.append(fmt)
+        else:
+            logger.warning(
+                f"responsive_images: format '{fmt}' is not supported by Pillow, skipping"
+            )
+    return supported
+
+
+def generate_images(app, env):
+    """Creates the derivatives for all raster images used in the documents."""
+    app.builder.responsive_images = {}
+    config = app.config
+
+    if not config.responsive_images_enabled or app.builder.name != "html":
+        return
+    if Image is None:
+        logger.warning("responsive_images: Pillow is not installed, skipping")
+        return
+
+    formats = supported_formats(config.responsive_images_formats)
+    if not formats:
+        return
+    key = encoding_key(config.responsive_images_quality)
+
+    cache_dir = os.path.join(app.confdir, config.responsive_images_cache_dir)
+    output_dir = os.path.join(app.outdir, OUTPUT_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Find out which images have derivatives missing from the cache
+    images = {}
+    jobs = []
+    for uri in env.images:
+        if not uri.lower().endswith(RASTER_EXTENSIONS):
+            continue
+        source = os.path.join(app.srcdir, uri)
+        if not os.path.isfile(source):
+            continue
+
+        digest = file_hash(source)
+        try:
+            with Image.open(source) as img:
+                source_width = img.width
+        except OSError as err:
+            logger.warning(f"responsive_images: cannot read {uri}: {err}")
+            continue
+
+        widths = target_widths(source_width, config.responsive_images_widths)
+        names = [
+            derivative_name(digest, key, w, fmt) for w in widths for fmt in formats
+        ]
+        if not all(os.path.exists(os.path.join(cache_dir, n)) for n in names):
+            jobs.append((source, digest, widths))
+        images[uri] = (digest, widths, names)
+
+    # Resize and encode the missing derivatives in parallel
+    if jobs:
+        logger.info(f"responsive_images: processing {len(jobs)} image(s)")
+        max_workers = config.responsive_images_max_workers or os.cpu_count()
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(
+                    make_derivatives,
+                    source,
+                    digest,
+                    widths,
+                    formats,
+                    config.responsive_images_quality,
+                    cache_dir,
+                )
+                for source, digest, widths in jobs
+            ]
+            for (source, _, _), future in zip(jobs, futures):
+                try:
+                    future.result()
+                except Exception as err:
+                    logger.warning(f"responsive_images: cannot encode {source}: {err}")
+
+    # Copy the derivatives to the build directory and store the srcset info
+    # for the HTML translator
+    for uri, (digest, widths, names) in images.items():
+        if not all(os.path.exists(os.path.join(cache_dir, n)) for n in names):
+            # Failed above, keep the plain image
+            continue
+        for name in names:
+            dest = os.path.join(output_dir, name)
+            if not os.path.exists(dest):
+                shutil.copyfile(os.path.join(cache_dir, name), dest)
+        app.builder.responsive_images[uri] = {
+            fmt: [(derivative_name(digest, key, w, fmt), w) for w in widths]
+            for fmt in formats
+        }
+
+    # Remove derivatives that no image of the current build refers to (old
+    # versions of edited images) and temporary files left behind by killed
+    # workers, so that the cache does not grow forever. Other files in the
+    # cache directory are never touched.
+    referenced = {n for _, _, names in images.values() for n in names}
+    for name in os.listdir(cache_dir):
+        if DERIVATIVE_PATTERN.fullmatch(name) and name not in referenced:
+            os.remove(os.path.join(cache_dir, name))
+
+
+def image_sizes(node, default):
+    """
+    Returns the value of the ``sizes`` attribute for an image node.
+
+    Parameters
+    ----------
+    node: <docutils.nodes.image>
+        Image node, after the ``:scale:`` option has been resolved.
+    default: <str>
+        Value used when the image has no explicit pixel width.
+
+    Returns
+    -------
+    <str>
+        Layout width of the image, so that browsers do not download a larger
+        candidate than the image is displayed at.
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*(px)?\s*", node.get("width", ""))
+    if match is None:
+        return default
+    width = round(float(match.group(1)) * node.get("scale", 100) / 100)
+    return f"(max-width: {width}px) 100vw, {width}px"
+
+
+def visit_image(self, node):
+    """Renders a raster image as a <picture> element with srcset candidates."""
+    olduri = node["uri"]
+    type(self).visit_image(self, node)
+
+    candidates = getattr(self.builder, "responsive_images", {}).get(olduri)
+    if not candidates or not self.body[-1].startswith("<img"):
+        return
+
+    sizes = self.attval(image_sizes(node, self.config.responsive_images_sizes))
+    sources = []
+    for fmt, derivatives in candidates.items():
+        srcset = ", ".join(
+            f"{posixpath.join(self.builder.imgpath, 'responsive', name)} {width}w"
+            for name, width in derivatives
+        )
+        sources.append(
+            f'<source type="{MIME_TYPES[fmt]}" srcset="{srcset}" sizes="{sizes}" />'
+        )
+
+    img = self.body[-1].rstrip()
+    suffix = self.body[-1][len(img) :]
+    extra = ""
+    if " loading=" not in img:
+        extra += ' loading="lazy"'
+    if " decoding=" not in img:
+        extra += ' decoding="async"'
+    img = re.sub(r"\s*/?>$", f"{extra} />", img)
+    self.body[-1] = "<picture>" + "".join(sources) + img + "</picture>" + suffix
+
+
+def depart_image(self, node):
+    type(self).depart_image(self, node)
+
+
+def setup(app):
+    app.add_config_value("responsive_images_enabled", True, "html")
+    app.add_config_value("responsive_images_widths", [480, 960, 1440], "html")
+    app.add_config_value("responsive_images_formats", ["avif", "webp"], "html")
+    app.add_config_value("responsive_images_quality", 75, "html")
+    app.add_config_value(
+        "responsive_images_sizes", "(max-width: 960px) 100vw, 960px", "html"
+    )
+    app.add_config_value("responsive_images_cache_dir", "../.image-cache", "html")
+    app.add_config_value("responsive_images_max_workers", 0, "html")
+
+    app.connect("env-updated", generate_images)
+    app.add_node(nodes.image, override=True, html=(visit_image, depart_image))
+
+    return {
+        "version": "0.1",
+        "parallel_read_safe": True,
+        "parallel_write_safe": True,
+    }
@@ -10,9 +10,10 @@
 # add these directories to sys.path here. If the directory is relative to the
 # documentation root, use os.path.abspath to make it absolute, like shown here.
 #
-# import os
-# import sys
-# sys.path.insert(0, os.path.abspath('.'))
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath("_ext"))
 
 # Pybtex related imports for handling the reference styles
 from pybtex.style.formatting.unsrt import Style as UnsrtStyle
@@ -46,6 +47,7 @@ extensions = [
     "sphinxcontrib.bibtex",
     "sphinx_thebe",
     "sphinx_design",
+    "responsive_images",
 ]
 
 # Add any paths that contain templates here, relative to this directory.
@@ -116,6 +118,18 @@ html_css_files = [
 # of the sidebar.
 html_logo = "_static/pythongis-logo.png"
 
+# -- Options for responsive images (_ext/responsive_images.py) --
+# Resized WebP/AVIF versions of the figures are generated at these widths and
+# served with srcset, the original PNG/JPEG is used as a fallback.
+# Read the Docs has no persistent image cache, so the derivatives would be
+# encoded from scratch on every build there. Disable the stage on RTD.
+responsive_images_enabled = os.environ.get("READTHEDOCS") != "True"
+responsive_images_widths = [480, 960, 1440]
+responsive_images_formats = ["avif", "webp"]
+# Keep the cache outside of the build directory so that it survives "make clean".
+# The CI build points IMAGE_CACHE_DIR outside of the repository checkout.
+responsive_images_cache_dir = os.environ.get("IMAGE_CACHE_DIR", "../.image-cache")
+
 # Add specification for master-doc
 # Relates to RTD issue: https://github.com/readthedocs/readthedocs.org/issues/2569
 master_doc = "index"